@@ -12,19 +12,38 @@ Telegram Bot для определения калорий в еде
 """
 
 import os
+import re
 import logging
 import asyncio
 from io import BytesIO
-from typing import Optional
+from typing import Optional, Dict, Tuple
+from collections import OrderedDict
 import hashlib
+import sqlite3
+import time
+import random
+import concurrent.futures
 
 import telegram
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram.constants import ChatAction
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 import openai
+import httpx
+import orjson
+import pybase64
+import PIL
 from PIL import Image
 from dotenv import load_dotenv
 
+# Семантический кэш - необязательная зависимость
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    np = None
+    SentenceTransformer = None
+
 # Загружаем переменные окружения из .env файла
 load_dotenv()
 
@@ -54,18 +73,378 @@ BUTTON_ANALYZE_PHOTO = "📸 Анализ блюда"
 BUTTON_SEARCH_CALORIES = "🔍 Поиск калорий"
 BUTTON_HELP = "❓ Помощь"
 
-# Создание клавиатуры
-def get_main_keyboard():
-    """Создает основную клавиатуру с кнопками"""
-    keyboard = [
+# Обработчики кнопок (имена методов CalorieBot)
+BUTTON_DISPATCH = {
+    BUTTON_START: "start_command",
+    BUTTON_ANALYZE_PHOTO: "handle_analyze_photo_button",
+    BUTTON_SEARCH_CALORIES: "handle_search_calories_button",
+    BUTTON_HELP: "help_command",
+}
+
+# Основная клавиатура (создается один раз)
+MAIN_KEYBOARD = ReplyKeyboardMarkup(
+    [
         [BUTTON_ANALYZE_PHOTO, BUTTON_SEARCH_CALORIES],
         [BUTTON_HELP, BUTTON_START]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False
+)
+
+# ===== ЗАПРОСЫ К OPENAI =====
+
+# Ответ модели, когда еды нет
+NO_FOOD_RE = re.compile(r"НЕТ[_ ]ЕДЫ", re.IGNORECASE)
+
+# Модель для анализа фото: у gpt-4o изображение с detail=low стоит 85 токенов,
+# а у gpt-4o-mini - 2833, поэтому для фото mini дороже и сильнее расходует TPM
+PHOTO_MODEL = "gpt-4o"
+# Модель для анализа текстовых описаний
+TEXT_MODEL = "gpt-4o-mini"
+
+# Запрос для анализа фото
+PHOTO_PROMPT = "Есть ли еда на фото? Еда включает: готовые блюда, сырые продукты, орехи, семечки, сухофрукты, крупы, фрукты, овощи. Если есть - оцени размер порции в граммах и рассчитай калории для этой порции. НЕ давай калории на 100г. ВАЖНО: 1 сосиска = ~150 ккал, 2 сосиски = ~300 ккал. Если нет еды - ответь 'НЕТ_ЕДЫ'. Формат: 'Продукт (~XXг) — ~XXX ккал'"
+
+# Запрос для анализа описания (само описание отправляется отдельным сообщением)
+TEXT_PROMPT = "Пользователь пришлет описание. Это еда? Еда включает: готовые блюда, сырые продукты, орехи, семечки, сухофрукты, крупы, фрукты, овощи. Если да - оцени размер порции в граммах и рассчитай калории для этой порции. НЕ давай калории на 100г. ВАЖНО: 1 сосиска = ~150 ккал, 2 сосиски = ~300 ккал. Если нет еды - ответь 'НЕТ_ЕДЫ'. Формат: 'Продукт (~XXг) — ~XXX ккал'"
+
+# Неизменяемые части запросов: одинаковый префикс позволяет OpenAI кэшировать его
+PHOTO_PROMPT_CONTENT = {"type": "text", "text": PHOTO_PROMPT}
+TEXT_PROMPT_MESSAGE = {"role": "system", "content": TEXT_PROMPT}
+
+# Максимальное количество закэшированных ответов по фото
+PHOTO_CACHE_SIZE = 512
+
+# Лимит исходящих сообщений Telegram (~30 в секунду на бота)
+TELEGRAM_SEND_RATE = 30
+
+# Время простоя, после которого обработчик очереди чата завершается
+CHAT_IDLE_TIMEOUT = 60.0
+# Как часто простаивающий обработчик проверяет, не остановлен ли бот
+CHAT_POLL_INTERVAL = 1.0
+
+# Максимальная длина описания, отправляемого в OpenAI
+TEXT_MAX_LENGTH = 512
+
+# Регулярные выражения для нормализации описаний
+_DECIMAL_COMMA_RE = re.compile(r"(\d),(\d)")
+# Удаляем только явный список знаков препинания: эмодзи, % и + несут смысл
+_PUNCTUATION_RE = re.compile(r"(?<!\d)[.,!?;:\"'()\[\]«»…-]|[.,!?;:\"'()\[\]«»…-](?!\d)")
+_GRAMS_RE = re.compile(r"(?:(?<=\d)|\b)(?:грамм(?:а|ов)?|гр)\b")
+_UNIT_SPACE_RE = re.compile(r"(\d)\s+(г|кг|мл|л|шт)\b")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+def _normalize_text(text: str) -> str:
+    """Приводит описание к единому виду, чтобы одинаковые запросы совпадали"""
+    text = text.casefold()
+    text = _DECIMAL_COMMA_RE.sub(r"\1.\2", text)
+    text = _PUNCTUATION_RE.sub(" ", text)
+    text = _GRAMS_RE.sub("г", text)
+    text = _UNIT_SPACE_RE.sub(r"\1\2", text)
+    text = _WHITESPACE_RE.sub(" ", text).strip()
+    return text[:TEXT_MAX_LENGTH]
+
+# Настройки семантического кэша для текстовых описаний
+SEMANTIC_CACHE_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_TTL = 24 * 60 * 60
+SEMANTIC_CACHE_DB = os.getenv('SEMANTIC_CACHE_DB', 'cache/semantic_cache.db')
+SEMANTIC_CACHE_SIZE = 10000
+SEMANTIC_CACHE_CHUNK = 1024
+
+# Числа в описании (количество, граммы, проценты)
+_NUMBER_RE = re.compile(r"\d+(?:[.,/]\d+)?")
+
+# Пул процессов для сжатия фото (Pillow не должен блокировать event loop)
+_IMG_POOL = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count())
+
+# Максимальная сторона фото, отправляемого в OpenAI (detail=low смотрит на 512x512)
+PHOTO_MAX_SIDE = 512
+# Максимальный размер фото для скачивания (лимит Bot API - 20 МБ)
+PHOTO_MAX_BYTES = 20 * 1024 * 1024
+# Небольшие JPEG такого размера отправляем без перекодирования
+PHOTO_PASSTHROUGH_BYTES = 150 * 1024
+
+def _preprocess_jpeg(photo_bytes: bytes) -> bytes:
+    """Уменьшает фото и сохраняет его в JPEG (выполняется в пуле процессов)"""
+    # Открываем изображение (пиксели декодируются только при необходимости)
+    image = Image.open(BytesIO(photo_bytes))
+    fits = max(image.size) <= PHOTO_MAX_SIDE
+    
+    # Маленький JPEG уже подходит - отправляем как есть
+    if fits and image.format == 'JPEG' and len(photo_bytes) < PHOTO_PASSTHROUGH_BYTES:
+        return photo_bytes
+    
+    # Конвертируем в RGB если нужно
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGB')
+    
+    # Сжимаем изображение для экономии
+    if not fits:
+        image.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE), Image.Resampling.BILINEAR)
+    
+    # Сохраняем в JPEG
+    img_buffer = BytesIO()
+    image.save(img_buffer, format='JPEG', quality=70, optimize=False)
+    return img_buffer.getvalue()
+
+def _prepare_photo(photo_bytes: bytes) -> Tuple[str, bytes]:
+    """Готовит data URL и ключ кэша для фото (выполняется в пуле процессов)"""
+    jpeg_bytes = _preprocess_jpeg(photo_bytes)
+    
+    # Ключ кэша - хэш сжатого изображения (криптостойкость не нужна, важна скорость)
+    key = hashlib.blake2b(jpeg_bytes, digest_size=32).digest()
+    
+    # Собираем data URL одной конкатенацией
+    image_url = "data:image/jpeg;base64," + pybase64.b64encode_as_string(jpeg_bytes)
+    return image_url, key
+
+# Повторы запросов к OpenAI при перегрузке и временных сбоях
+OPENAI_MAX_RETRIES = 4
+OPENAI_RETRY_STATUSES = (408, 409, 429)
+
+def _should_retry(error: Exception) -> bool:
+    """Повторяем те же ошибки, что и OpenAI SDK: обрыв соединения, 408/409/429 и 5xx"""
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in OPENAI_RETRY_STATUSES or error.status_code >= 500
+    return False
+
+async def _with_backoff(coro_factory, timeout: float, max_retries: int = OPENAI_MAX_RETRIES):
+    """Выполняет запрос к OpenAI с повторами, укладываясь в общий timeout"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    for attempt in range(max_retries + 1):
+        try:
+            return await asyncio.wait_for(coro_factory(), max(deadline - loop.time(), 0))
+        except Exception as e:
+            if not _should_retry(e) or attempt == max_retries:
+                raise
+            
+            # Учитываем Retry-After от сервера, если он есть
+            delay = None
+            response = getattr(e, "response", None)
+            retry_after = response.headers.get("retry-after") if response is not None else None
+            if retry_after:
+                try:
+                    delay = float(retry_after)
+                except ValueError:
+                    pass
+            if delay is None:
+                delay = min(16, 0.5 * 2 ** attempt) + random.random() * 0.25
+            
+            # Не ждем, если повтор все равно не успеет до конца отведенного времени
+            if delay >= deadline - loop.time():
+                raise
+            
+            logger.warning(f"OpenAI request failed ({e}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+class SemanticCache:
+    """Кэш ответов по смыслу текста на основе локальных эмбеддингов"""
+    
+    def __init__(self, model_name: str, db_path: str, threshold: float, ttl: float,
+                 max_size: int = SEMANTIC_CACHE_SIZE):
+        self.model = SentenceTransformer(model_name)
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.dim = self.model.get_sentence_embedding_dimension()
+        
+        # Нормализованные эмбеддинги и параллельные массивы ответов и времени.
+        # Живые записи лежат в [start:end], массивы растут блоками по SEMANTIC_CACHE_CHUNK
+        self.matrix = np.empty((SEMANTIC_CACHE_CHUNK, self.dim), dtype=np.float32)
+        self.timestamps = np.empty(SEMANTIC_CACHE_CHUNK, dtype=np.float64)
+        self.entries = []
+        self.start = 0
+        self.end = 0
+        
+        # Сохраняем кэш в sqlite, чтобы он переживал перезапуски.
+        # Запись идет в отдельном потоке, чтобы не блокировать event loop
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS semantic_cache "
+            "(text TEXT, response TEXT, embedding BLOB, created REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS semantic_cache_created ON semantic_cache (created)")
+        self._db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._load()
+    
+    def _load(self) -> None:
+        """Загружает неустаревшие записи из базы (вызывается при старте)"""
+        cutoff = time.time() - self.ttl
+        self.db.execute("DELETE FROM semantic_cache WHERE created < ?", (cutoff,))
+        self.db.commit()
+        rows = self.db.execute(
+            "SELECT text, response, embedding, created FROM semantic_cache ORDER BY created DESC LIMIT ?",
+            (self.max_size,)
+        ).fetchall()
+        for text, response, embedding, created in reversed(rows):
+            self._append(text, np.frombuffer(embedding, dtype=np.float32), response, created)
+        if rows:
+            logger.info(f"Loaded {len(rows)} semantic cache entries")
+    
+    @staticmethod
+    def _numbers(text: str) -> Tuple[str, ...]:
+        """Числа из описания - у похожих текстов они должны совпадать"""
+        return tuple(n.replace(",", ".") for n in _NUMBER_RE.findall(text))
+    
+    def _append(self, text: str, embedding, response: str, created: float) -> None:
+        """Добавляет запись в память, вытесняя самую старую при переполнении"""
+        if self.end - self.start >= self.max_size:
+            self.start += 1
+        
+        if self.end == len(self.timestamps):
+            # Сдвигаем живые записи в начало и при необходимости расширяем массивы
+            live = self.end - self.start
+            capacity = len(self.timestamps)
+            if live + SEMANTIC_CACHE_CHUNK > capacity:
+                capacity = min(live + SEMANTIC_CACHE_CHUNK, self.max_size + SEMANTIC_CACHE_CHUNK)
+            matrix = np.empty((capacity, self.dim), dtype=np.float32)
+            timestamps = np.empty(capacity, dtype=np.float64)
+            matrix[:live] = self.matrix[self.start:self.end]
+            timestamps[:live] = self.timestamps[self.start:self.end]
+            self.matrix, self.timestamps = matrix, timestamps
+            self.entries = self.entries[self.start:self.end]
+            self.start, self.end = 0, live
+        
+        self.matrix[self.end] = embedding
+        self.timestamps[self.end] = created
+        self.entries.append((response, self._numbers(text)))
+        self.end += 1
+    
+    def _evict_expired(self) -> None:
+        """Пропускает записи старше TTL (записи упорядочены по времени)"""
+        cutoff = time.time() - self.ttl
+        self.start += int(np.searchsorted(self.timestamps[self.start:self.end], cutoff))
+    
+    def embed(self, text: str):
+        """Считает нормализованный эмбеддинг текста (вызывать вне event loop)"""
+        return self.model.encode(text, normalize_embeddings=True).astype(np.float32)
+    
+    def lookup(self, text: str, embedding) -> Optional[str]:
+        """Возвращает ответ для самого похожего текста с теми же числами"""
+        self._evict_expired()
+        if self.start == self.end:
+            return None
+        similarities = self.matrix[self.start:self.end] @ embedding
+        candidates = np.flatnonzero(similarities >= self.threshold)
+        if not len(candidates):
+            return None
+        
+        # "2 яблока" и "3 яблока" почти совпадают по смыслу, но не по калориям
+        numbers = self._numbers(text)
+        for i in candidates[np.argsort(-similarities[candidates])]:
+            response, entry_numbers = self.entries[self.start + i]
+            if entry_numbers == numbers:
+                return response
+        return None
+    
+    def add(self, text: str, embedding, response: str) -> None:
+        """Добавляет новый ответ в кэш, запись в базу выполняется в фоне"""
+        now = time.time()
+        self._append(text, embedding, response, now)
+        self._db_executor.submit(self._persist, text, response, embedding.tobytes(), now)
+    
+    def _persist(self, text: str, response: str, embedding: bytes, created: float) -> None:
+        """Сохраняет запись в базу и удаляет устаревшие (в потоке базы)"""
+        try:
+            self.db.execute(
+                "INSERT INTO semantic_cache VALUES (?, ?, ?, ?)",
+                (text, response, embedding, created)
+            )
+            self.db.execute("DELETE FROM semantic_cache WHERE created < ?", (created - self.ttl,))
+            self.db.commit()
+        except Exception as e:
+            logger.error(f"Error persisting semantic cache entry: {e}")
+
+class OrjsonAsyncClient(httpx.AsyncClient):
+    """HTTP клиент, сериализующий JSON тела запросов через orjson"""
+    
+    def build_request(self, method, url, *, json=None, **kwargs) -> httpx.Request:
+        if json is not None and kwargs.get("content") is None:
+            try:
+                kwargs["content"] = orjson.dumps(json)
+            except TypeError:
+                # Типы, которые orjson не умеет сериализовать, отдаем httpx
+                return super().build_request(method, url, json=json, **kwargs)
+            headers = httpx.Headers(kwargs.get("headers"))
+            headers.setdefault("Content-Type", "application/json")
+            kwargs["headers"] = headers
+            return super().build_request(method, url, **kwargs)
+        return super().build_request(method, url, json=json, **kwargs)
+
+# Общий HTTP/2 пул соединений и клиент OpenAI для всего процесса
+_HTTPX = OrjsonAsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=256, max_keepalive_connections=64),
+    timeout=httpx.Timeout(20.0, connect=5.0)
+)
+CLIENT = openai.AsyncOpenAI(
+    api_key=openai.api_key,
+    # Повторы выполняет _with_backoff, встроенные отключаем
+    max_retries=0,
+    http_client=_HTTPX
+)
+
+class TokenBucket:
+    """Ограничитель частоты: не больше capacity операций, пополнение rate в секунду"""
+    
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self) -> None:
+        """Ждет, пока не освободится токен (ожидающие обслуживаются по очереди)"""
+        async with self._lock:
+            while True:
+                # Пополняем токены по прошедшему времени вместо фоновой задачи
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
 class CalorieBot:
+    # Кэш ответов по BLAKE2b-хэшу сжатого JPEG (общий для всех экземпляров)
+    _photo_cache: "OrderedDict[bytes, str]" = OrderedDict()
+    
     def __init__(self):
-        self.openai_client = openai.OpenAI(api_key=openai.api_key)
+        # Запросы в процессе выполнения: одинаковые фото и тексты ждут один результат
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # Общий лимит на отправку сообщений в Telegram
+        self._bucket = TokenBucket(TELEGRAM_SEND_RATE, TELEGRAM_SEND_RATE)
+        # Очереди обновлений по чатам: порядок внутри чата, параллельность между чатами
+        self._chat_queues: Dict[int, asyncio.Queue] = {}
+        self._chat_workers: Dict[int, asyncio.Task] = {}
+        # Семантический кэш для текстов (модель загружается один раз при старте)
+        self.semantic_cache: Optional[SemanticCache] = None
+        if SentenceTransformer is not None:
+            try:
+                self.semantic_cache = SemanticCache(
+                    SEMANTIC_CACHE_MODEL,
+                    SEMANTIC_CACHE_DB,
+                    SEMANTIC_CACHE_THRESHOLD,
+                    SEMANTIC_CACHE_TTL
+                )
+            except Exception as e:
+                logger.error(f"Error initializing semantic cache: {e}")
+        else:
+            logger.info("sentence-transformers is not installed, semantic cache disabled")
+    
+    async def _send(self, method, *args, **kwargs):
+        """Вызывает метод отправки Telegram с учетом лимита сообщений"""
+        await self._bucket.acquire()
+        return await method(*args, **kwargs)
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик команды /start"""
@@ -78,9 +457,10 @@ class CalorieBot:
 
 Используйте кнопки внизу для навигации!
         """
-        await update.message.reply_text(
+        await self._send(
+            update.message.reply_text,
             welcome_message, 
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -100,27 +480,19 @@ class CalorieBot:
 
 💡 Калории указаны приблизительно, используйте как ориентир.
         """
-        await update.message.reply_text(
+        await self._send(
+            update.message.reply_text,
             help_message,
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
     
     async def handle_button_press(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик нажатий кнопок и текстовых сообщений"""
         text = update.message.text
         
-        # Проверяем, нажата ли кнопка
-        if text == BUTTON_START:
-            await self.start_command(update, context)
-        elif text == BUTTON_ANALYZE_PHOTO:
-            await self.handle_analyze_photo_button(update, context)
-        elif text == BUTTON_SEARCH_CALORIES:
-            await self.handle_search_calories_button(update, context)
-        elif text == BUTTON_HELP:
-            await self.help_command(update, context)
-        else:
-            # Если это не кнопка, то это текстовое описание еды
-            await self.handle_text(update, context)
+        # Если это не кнопка, то это текстовое описание еды
+        handler = getattr(self, BUTTON_DISPATCH.get(text, "handle_text"))
+        await handler(update, context)
     
     async def handle_analyze_photo_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик кнопки 'Анализ блюда'"""
@@ -134,7 +506,7 @@ class CalorieBot:
 
 Просто отправьте фото! 📷
         """
-        await update.message.reply_text(message)
+        await self._send(update.message.reply_text, message)
     
     async def handle_search_calories_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик кнопки 'Поиск калорий'"""
@@ -151,100 +523,103 @@ class CalorieBot:
 
 Напишите что вы ели! ✍️
         """
-        await update.message.reply_text(message)
+        await self._send(update.message.reply_text, message)
     
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик фотографий с оптимизированной скоростью"""
         try:
-            # Немедленная обратная связь
-            processing_msg = await update.message.reply_text("🔍 Анализирую ваше фото...", reply_markup=get_main_keyboard())
+            # Немедленная обратная связь (не расходует лимит сообщений)
+            await context.bot.send_chat_action(update.effective_chat.id, ChatAction.TYPING)
+            
+            # Берем самый маленький вариант фото, которого хватает для анализа
+            photo = next(
+                (p for p in update.message.photo if max(p.width, p.height) >= PHOTO_MAX_SIDE),
+                update.message.photo[-1]
+            )
             
-            # Получаем фото в наилучшем качестве
-            photo = update.message.photo[-1]
+            # Проверяем размер фото по данным Telegram, еще до скачивания
+            if photo.file_size is not None and photo.file_size < 1000:
+                await self._send(
+                    update.message.reply_text,
+                    "⚠️ Фото слишком маленькое для качественного анализа. Попробуйте отправить фото в лучшем качестве.",
+                    reply_markup=MAIN_KEYBOARD
+                )
+                return
+            if photo.file_size is not None and photo.file_size > PHOTO_MAX_BYTES:
+                await self._send(
+                    update.message.reply_text,
+                    "⚠️ Фото слишком большое. Попробуйте отправить фото поменьше.",
+                    reply_markup=MAIN_KEYBOARD
+                )
+                return
             
-            # Скачиваем фото
+            # Скачиваем фото сразу в буфер в памяти
             file = await context.bot.get_file(photo.file_id)
-            photo_bytes = await file.download_as_bytearray()
+            buf = BytesIO()
+            await file.download_to_memory(buf)
+            photo_bytes = buf.getvalue()
             
-            # Проверяем размер фото
+            # Размер может быть неизвестен заранее - проверяем после скачивания
             if len(photo_bytes) < 1000:
-                await update.message.reply_text(
+                await self._send(
+                    update.message.reply_text,
                     "⚠️ Фото слишком маленькое для качественного анализа. Попробуйте отправить фото в лучшем качестве.",
-                    reply_markup=get_main_keyboard()
+                    reply_markup=MAIN_KEYBOARD
                 )
                 return
             
             # Обрабатываем фото
-            result = await self.analyze_food_photo_with_progress(photo_bytes, processing_msg)
+            result = await self.analyze_food_photo_with_progress(photo_bytes)
             
             # Отправляем результат
-            await update.message.reply_text(result, reply_markup=get_main_keyboard())
+            await self._send(update.message.reply_text, result, reply_markup=MAIN_KEYBOARD)
             
         except Exception as e:
             logger.error(f"Error processing photo: {e}")
-            await update.message.reply_text(
+            await self._send(
+                update.message.reply_text,
                 "❌ Извините, не смог обработать фото. Попробуйте отправить более четкое изображение еды.",
-                reply_markup=get_main_keyboard()
+                reply_markup=MAIN_KEYBOARD
             )
     
     async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик текстовых сообщений с оптимизацией"""
         try:
-            # Немедленная обратная связь
-            processing_msg = await update.message.reply_text("🔍 Анализирую описание еды...", reply_markup=get_main_keyboard())
+            # Немедленная обратная связь (не расходует лимит сообщений)
+            await context.bot.send_chat_action(update.effective_chat.id, ChatAction.TYPING)
             
             # Обрабатываем текст
-            result = await self.analyze_food_text_with_progress(update.message.text, processing_msg)
+            result = await self.analyze_food_text_with_progress(update.message.text)
             
             # Отправляем результат
-            await update.message.reply_text(result, reply_markup=get_main_keyboard())
+            await self._send(update.message.reply_text, result, reply_markup=MAIN_KEYBOARD)
             
         except Exception as e:
             logger.error(f"Error processing text: {e}")
-            await update.message.reply_text(
+            await self._send(
+                update.message.reply_text,
                 "❌ Извините, не смог обработать сообщение. Попробуйте описать еду более четко.",
-                reply_markup=get_main_keyboard()
+                reply_markup=MAIN_KEYBOARD
             )
     
-    async def analyze_food_photo_with_progress(self, photo_bytes: bytes, processing_msg) -> str:
+    async def analyze_food_photo_with_progress(self, photo_bytes: bytes) -> str:
         """Быстрый и простой анализ фото"""
         try:
             # Проверяем размер фото
             if len(photo_bytes) < 1000:
                 return "❌ Фото слишком маленькое. Попробуйте другое."
             
-            # Конвертируем байты в base64
-            import base64
-            from PIL import Image
-            import io
-            
-            # Проверяем и конвертируем изображение в JPEG
+            # Сжатие, хэш и base64 выполняются в отдельном процессе, не блокируя event loop
             try:
-                # Открываем изображение
-                image = Image.open(io.BytesIO(photo_bytes))
-                
-                # Конвертируем в RGB если нужно
-                if image.mode in ('RGBA', 'LA', 'P'):
-                    image = image.convert('RGB')
-                
-                # Сжимаем изображение для экономии
-                image.thumbnail((1024, 1024), Image.Resampling.LANCZOS)
-                
-                # Сохраняем в JPEG
-                img_buffer = io.BytesIO()
-                image.save(img_buffer, format='JPEG', quality=85, optimize=True)
-                img_buffer.seek(0)
-                
-                # Конвертируем в base64
-                base64_image = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
-                
+                image_url, key = await asyncio.get_running_loop().run_in_executor(
+                    _IMG_POOL, _prepare_photo, photo_bytes
+                )
             except Exception as img_error:
                 logger.error(f"Error processing image: {img_error}")
-                # Fallback - используем оригинальные байты
-                base64_image = base64.b64encode(photo_bytes).decode('utf-8')
+                return "❌ Не смог распознать изображение. Попробуйте другое фото."
             
             # Один быстрый анализ
-            result = await self._single_food_analysis(base64_image)
+            result = await self._single_food_analysis(image_url, key)
             
             return f"📸 {result}"
             
@@ -256,35 +631,71 @@ class CalorieBot:
     
     
     
-    async def _single_food_analysis(self, base64_image: str) -> str:
+    def _get_cached_photo_result(self, key: bytes) -> Optional[str]:
+        """Возвращает закэшированный ответ по фото, если он есть"""
+        result = self._photo_cache.get(key)
+        if result is not None:
+            self._photo_cache.move_to_end(key)
+        return result
+    
+    def _store_photo_result(self, key: bytes, result: str) -> None:
+        """Сохраняет ответ по фото в кэш, вытесняя самые старые записи"""
+        self._photo_cache[key] = result
+        self._photo_cache.move_to_end(key)
+        while len(self._photo_cache) > PHOTO_CACHE_SIZE:
+            self._photo_cache.popitem(last=False)
+    
+    async def _single_flight(self, key: str, factory) -> str:
+        """Объединяет одинаковые одновременные запросы в один вызов OpenAI"""
+        # Между проверкой и вставкой нет await, поэтому отдельная блокировка не нужна
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield - отмена одного ожидающего не должна отменять запрос для остальных
+        return await asyncio.shield(task)
+    
+    async def _single_food_analysis(self, image_url: str, key: Optional[bytes] = None) -> str:
         """Проверяет наличие еды и анализирует калории в одном запросе"""
+        if key is None:
+            return await self._request_food_analysis(image_url)
+        
+        # Быстрый путь - ответ уже в кэше
+        cached = self._get_cached_photo_result(key)
+        if cached is not None:
+            return cached
+        
+        async def fetch() -> str:
+            result = await self._request_food_analysis(image_url)
+            # Кэшируем только успешные ответы, ошибки можно повторить
+            if not result.startswith(("❌", "⏰")):
+                self._store_photo_result(key, result)
+            return result
+        
+        # Одинаковые фото ждут один и тот же запрос
+        return await self._single_flight(f"photo:{key.hex()}", fetch)
+    
+    async def _request_food_analysis(self, image_url: str) -> str:
+        """Отправляет фото в OpenAI и возвращает ответ"""
         try:
             # Проверяем размер изображения
-            if len(base64_image) < 1000:
+            if len(image_url) < 1000:
                 return "❌ Фото слишком маленькое. Попробуйте другое."
             
-            # Проверяем API ключ
-            if not self.openai_client.api_key:
-                logger.error("OpenAI API key is not set")
-                return "❌ Ошибка конфигурации. Обратитесь к администратору."
-            
             # Один запрос: проверяем еду и анализируем калории
-            response = await asyncio.wait_for(
-                asyncio.to_thread(
-                    self.openai_client.chat.completions.create,
-                    model="gpt-4o",
+            response = await _with_backoff(
+                lambda: CLIENT.chat.completions.create(
+                    model=PHOTO_MODEL,
                     messages=[
                         {
                             "role": "user",
                             "content": [
-                                {
-                                    "type": "text",
-                                    "text": "Есть ли еда на фото? Еда включает: готовые блюда, сырые продукты, орехи, семечки, сухофрукты, крупы, фрукты, овощи. Если есть - оцени размер порции в граммах и рассчитай калории для этой порции. НЕ давай калории на 100г. ВАЖНО: 1 сосиска = ~150 ккал, 2 сосиски = ~300 ккал. Если нет еды - ответь 'НЕТ_ЕДЫ'. Формат: 'Продукт (~XXг) — ~XXX ккал'"
-                                },
+                                PHOTO_PROMPT_CONTENT,
                                 {
                                     "type": "image_url",
                                     "image_url": {
-                                        "url": f"data:image/jpeg;base64,{base64_image}",
+                                        "url": image_url,
                                         "detail": "low"
                                     }
                                 }
@@ -304,7 +715,7 @@ class CalorieBot:
                 return "❌ Не смог распознать изображение. Попробуйте другое фото."
             
             # Проверяем, есть ли еда на фото
-            if "НЕТ_ЕДЫ" in result.upper() or "НЕТ ЕДЫ" in result.upper():
+            if NO_FOOD_RE.search(result):
                 return "❌ На фото не удалось найти еду."
             
             return result
@@ -321,27 +732,66 @@ class CalorieBot:
     
     async def _single_text_analysis(self, text: str) -> str:
         """Проверяет, описывает ли текст еду, и анализирует калории"""
+        normalized = _normalize_text(text)
+        if not any(c.isalpha() for c in normalized):
+            # Без букв (эмодзи, одни числа) разные описания легко совпадут после
+            # нормализации - отправляем исходный текст без общих запросов и кэша
+            return await self._request_text_analysis(text.strip()[:TEXT_MAX_LENGTH])
+        
+        # Нормализованный текст используется и для кэша, и для запроса.
+        # Одинаковые описания ждут один и тот же запрос
+        return await self._single_flight(
+            f"text:{normalized}",
+            lambda: self._cached_text_analysis(normalized)
+        )
+    
+    async def _cached_text_analysis(self, text: str) -> str:
+        """Анализ текста с использованием семантического кэша"""
+        if self.semantic_cache is None:
+            return await self._request_text_analysis(text)
+        
+        # Ищем похожее описание в семантическом кэше
         try:
-            response = await asyncio.wait_for(
-                asyncio.to_thread(
-                    self.openai_client.chat.completions.create,
-                    model="gpt-4o",
-                    messages=[
-                        {
-                            "role": "user", 
-                            "content": f"Это еда: '{text}'? Еда включает: готовые блюда, сырые продукты, орехи, семечки, сухофрукты, крупы, фрукты, овощи. Если да - оцени размер порции в граммах и рассчитай калории для этой порции. НЕ давай калории на 100г. ВАЖНО: 1 сосиска = ~150 ккал, 2 сосиски = ~300 ккал. Если нет еды - ответь 'НЕТ_ЕДЫ'. Формат: 'Продукт (~XXг) — ~XXX ккал'"
-                        }
-                    ],
-                    max_tokens=60,
-                    temperature=0.1
-                ),
-                timeout=6.0
-            )
-            
-            result = response.choices[0].message.content.strip()
+            embedding = await asyncio.to_thread(self.semantic_cache.embed, text)
+            cached = self.semantic_cache.lookup(text, embedding)
+        except Exception as e:
+            logger.error(f"Error in semantic cache lookup: {e}")
+            return await self._request_text_analysis(text)
+        if cached is not None:
+            return cached
+        
+        result = await self._request_text_analysis(text)
+        # Кэшируем только успешные ответы, ошибки можно повторить
+        if not result.startswith(("❌", "⏰")):
+            try:
+                self.semantic_cache.add(text, embedding, result)
+            except Exception as e:
+                logger.error(f"Error storing semantic cache entry: {e}")
+        return result
+    
+    async def _complete_text(self, text: str) -> str:
+        """Анализирует одно описание отдельным запросом"""
+        response = await _with_backoff(
+            lambda: CLIENT.chat.completions.create(
+                model=TEXT_MODEL,
+                messages=[
+                    TEXT_PROMPT_MESSAGE,
+                    {"role": "user", "content": text}
+                ],
+                max_tokens=60,
+                temperature=0.1
+            ),
+            timeout=6.0
+        )
+        return response.choices[0].message.content.strip()
+    
+    async def _request_text_analysis(self, text: str) -> str:
+        """Отправляет описание в OpenAI и возвращает ответ"""
+        try:
+            result = await self._complete_text(text)
             
             # Проверяем, описывает ли текст еду
-            if "НЕТ_ЕДЫ" in result.upper() or "НЕТ ЕДЫ" in result.upper():
+            if NO_FOOD_RE.search(result):
                 return "❌ В описании не удалось найти еду."
             
             return result
@@ -352,7 +802,7 @@ class CalorieBot:
             logger.error(f"Error in text analysis: {e}")
             return "❌ Ошибка при анализе. Попробуйте еще раз."
     
-    async def analyze_food_text_with_progress(self, text: str, processing_msg) -> str:
+    async def analyze_food_text_with_progress(self, text: str) -> str:
         """Быстрый анализ текста"""
         try:
             # Один быстрый анализ
@@ -366,14 +816,62 @@ class CalorieBot:
     
     
     
+    def chat_queued(self, handler):
+        """Оборачивает обработчик, чтобы обновления одного чата шли по очереди"""
+        async def enqueue(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+            if update.effective_chat is None:
+                await handler(update, context)
+                return
+            
+            chat_id = update.effective_chat.id
+            queue = self._chat_queues.get(chat_id)
+            if queue is None:
+                # Обработчик очереди создается при первом обновлении из чата.
+                # create_task приложения - чтобы PTB дождался задачи при остановке
+                queue = asyncio.Queue()
+                self._chat_queues[chat_id] = queue
+                self._chat_workers[chat_id] = context.application.create_task(
+                    self._chat_worker(chat_id, queue, context.application)
+                )
+            queue.put_nowait((update, context, handler))
+        
+        return enqueue
+    
+    async def _chat_worker(self, chat_id: int, queue: asyncio.Queue, application: Application) -> None:
+        """Последовательно обрабатывает обновления одного чата"""
+        try:
+            idle = 0.0
+            while True:
+                try:
+                    update, context, handler = await asyncio.wait_for(queue.get(), CHAT_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    idle += CHAT_POLL_INTERVAL
+                    # Завершаемся после простоя или когда бот останавливается
+                    if queue.empty() and (idle >= CHAT_IDLE_TIMEOUT or not application.running):
+                        break
+                    continue
+                
+                idle = 0.0
+                try:
+                    await handler(update, context)
+                except Exception as e:
+                    # Передаем ошибку в обработчики ошибок приложения (error_handler)
+                    await application.process_error(update, e)
+        finally:
+            # Освобождаем память после простоя
+            if self._chat_queues.get(chat_id) is queue:
+                del self._chat_queues[chat_id]
+                del self._chat_workers[chat_id]
+    
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик ошибок - логирует ошибку и уведомляет пользователя"""
         logger.error(f"Exception while handling an update: {context.error}")
         
         if update and update.effective_message:
-            await update.effective_message.reply_text(
+            await self._send(
+                update.effective_message.reply_text,
                 "❌ Извините, что-то пошло не так. Попробуйте позже.",
-                reply_markup=get_main_keyboard()
+                reply_markup=MAIN_KEYBOARD
             )
 
 def main():
@@ -384,19 +882,21 @@ def main():
     # Создаем приложение
     application = Application.builder().token(TELEGRAM_TOKEN).build()
     
-    # Добавляем обработчики
-    application.add_handler(CommandHandler("start", bot.start_command))
-    application.add_handler(CommandHandler("help", bot.help_command))
+    # Добавляем обработчики (обновления каждого чата обрабатываются по очереди)
+    application.add_handler(CommandHandler("start", bot.chat_queued(bot.start_command)))
+    application.add_handler(CommandHandler("help", bot.chat_queued(bot.help_command)))
     
     # Обработчики сообщений
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_button_press))
-    application.add_handler(MessageHandler(filters.PHOTO, bot.handle_photo))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.chat_queued(bot.handle_button_press)))
+    application.add_handler(MessageHandler(filters.PHOTO, bot.chat_queued(bot.handle_photo)))
     
     # Добавляем обработчик ошибок
     application.add_error_handler(bot.error_handler)
     
     # Запускаем бота
     logger.info("Starting Calorie Estimation Bot...")
+    # Pillow-SIMD имеет суффикс .postN в версии
+    logger.info(f"Using Pillow {PIL.__version__}")
     print("🤖 Бот подсчета калорий запущен!")
     print("Нажмите Ctrl+C для остановки")
     